@@ -0,0 +1,214 @@
+"""
+Remote probe agent.
+
+Pull the services assigned to this agent from the monitor server, check them
+locally on their cron schedule and push the results back in gzip batches.
+Results that cannot be delivered are kept in AGENT_SPOOL_DIR and resent later.
+
+    AGENT_SERVER_URL=https://monitor.example.com AGENT_TOKEN=<api key> \\
+    AGENT_LOCATION=hanoi python agent.py
+"""
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.triggers.cron import CronTrigger
+from dotenv import load_dotenv
+from datetime import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import pytz
+import requests
+
+load_dotenv()
+
+SERVER_URL = os.getenv("AGENT_SERVER_URL", "http://localhost:5000").rstrip("/")
+TOKEN = os.getenv("AGENT_TOKEN", "")
+LOCATION = os.getenv("AGENT_LOCATION", "default")
+CONCURRENCY = int(os.getenv("AGENT_CONCURRENCY", 10))
+BATCH_SIZE = int(os.getenv("AGENT_BATCH_SIZE", 100))
+FLUSH_INTERVAL = int(os.getenv("AGENT_FLUSH_INTERVAL", 10))
+SPOOL_DIR = os.getenv("AGENT_SPOOL_DIR", "agent-spool")
+
+tz = pytz.timezone('Asia/Bangkok')
+scheduler = BackgroundScheduler(
+    executors={"default": ThreadPoolExecutor(CONCURRENCY)})
+
+# service_id -> cấu hình dịch vụ đang được lên lịch
+_assignments = {}
+_pending = []
+_pending_lock = threading.Lock()
+
+
+def _headers():
+    return {"Authorization": f"Bearer {TOKEN}"}
+
+
+def probe_service(service):
+    start = datetime.now(tz)
+    request_kwargs = {
+        "url": service["url"],
+        "cookies": service.get("cookies") or {},
+        "timeout": service.get("timeout") or 5
+    }
+    method = service["method"].upper()
+    if method in ("POST", "PUT", "PATCH"):
+        request_kwargs["json"] = service.get("data") or {}
+
+    try:
+        response = requests.request(method, **request_kwargs)
+        if 400 <= response.status_code < 600:
+            status = "DOWN"
+            error = f"HTTP {response.status_code} - {response.text[:500]}"
+        else:
+            status = "UP"
+            error = None
+    except Exception as e:
+        status = "DOWN"
+        error = str(e)
+
+    finish_time = datetime.now(tz)
+    result = {
+        "service_id": service["id"],
+        "status": status,
+        "finish_time": finish_time.isoformat(),
+        "response_time": round((finish_time - start).total_seconds() * 1000),
+        "error": error,
+        "location": LOCATION
+    }
+    with _pending_lock:
+        _pending.append(result)
+
+
+def _cron_trigger(cron):
+    cron_parts = cron.strip().split()
+    if len(cron_parts) > 5:
+        raise ValueError(f"Invalid cron format '{cron}' (must have 5 fields)")
+    return CronTrigger.from_crontab(" ".join(cron_parts + ["*"] * (5 - len(cron_parts))))
+
+
+def refresh_assignments():
+    """Sync the local schedule with the server, return the next refresh delay"""
+    response = requests.get(
+        f"{SERVER_URL}/api/agent/assignments", headers=_headers(), timeout=10)
+    response.raise_for_status()
+    data = response.json()
+
+    services = {s["id"]: s for s in data["services"]}
+    for service_id in list(_assignments):
+        if service_id not in services:
+            scheduler.remove_job(f"agent_service_{service_id}")
+            del _assignments[service_id]
+            print(f"Remove job for service {service_id}")
+
+    for service_id, service in services.items():
+        if _assignments.get(service_id) == service:
+            continue
+        try:
+            scheduler.add_job(
+                func=probe_service,
+                trigger=_cron_trigger(service["cron"]),
+                args=[service],
+                id=f"agent_service_{service_id}",
+                replace_existing=True
+            )
+            _assignments[service_id] = service
+            print(f"Add job for service {service_id}: {service['name']}")
+        except Exception as e:
+            print(f"[ERROR] Failed to add cron for service ID {service_id}: {e}")
+
+    return data.get("refresh_interval", 60)
+
+
+def _send_batch(payload):
+    response = requests.post(
+        f"{SERVER_URL}/api/agent/results",
+        data=payload,
+        headers={
+            **_headers(),
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip"
+        },
+        timeout=30
+    )
+    # 4xx = dữ liệu không hợp lệ, gửi lại cũng vô ích
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code >= 400:
+        print(f"[ERROR] Batch rejected: {response.status_code} {response.text}")
+
+
+def _spool(payload):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, f"batch-{time.time_ns()}.json.gz")
+    with open(path, "wb") as f:
+        f.write(payload)
+    print(f"[WARN] Server unreachable, buffered batch to {path}")
+
+
+def _flush_spool():
+    """Resend buffered batches oldest first, return False if the server is still unreachable"""
+    if not os.path.isdir(SPOOL_DIR):
+        return True
+    for name in sorted(os.listdir(SPOOL_DIR)):
+        path = os.path.join(SPOOL_DIR, name)
+        with open(path, "rb") as f:
+            payload = f.read()
+        try:
+            _send_batch(payload)
+        except Exception:
+            return False
+        os.remove(path)
+    return True
+
+
+def flush_results():
+    with _pending_lock:
+        results = _pending[:]
+        _pending.clear()
+
+    # Gửi lại dữ liệu cũ trước để server nhận theo đúng thứ tự thời gian
+    spool_sent = _flush_spool()
+
+    for i in range(0, len(results), BATCH_SIZE):
+        payload = gzip.compress(json.dumps({
+            "location": LOCATION,
+            "results": results[i:i + BATCH_SIZE]
+        }).encode("utf-8"))
+        if not spool_sent:
+            _spool(payload)
+            continue
+        try:
+            _send_batch(payload)
+        except Exception as e:
+            print(f"[ERROR] Failed to push results: {e}")
+            spool_sent = False
+            _spool(payload)
+
+
+def run():
+    scheduler.start()
+    next_refresh = 0
+    next_flush = time.monotonic() + FLUSH_INTERVAL
+
+    while True:
+        now = time.monotonic()
+        if now >= next_refresh:
+            try:
+                next_refresh = now + refresh_assignments()
+            except Exception as e:
+                print(f"[ERROR] Failed to load assignments: {e}")
+                next_refresh = now + FLUSH_INTERVAL
+
+        with _pending_lock:
+            pending = len(_pending)
+        if now >= next_flush or pending >= BATCH_SIZE:
+            flush_results()
+            next_flush = time.monotonic() + FLUSH_INTERVAL
+
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,17 +1,23 @@
 from functools import wraps
 from dotenv import load_dotenv
 from datetime import datetime
+import json
+import zlib
 import os
+import pytz
 from flask import Flask, request, jsonify,  send_from_directory, session
-from models import db, Service, StatusService,  HttpMethod, User, Category, ServiceStatus, APIKey
+from models import db, Service, StatusService,  HttpMethod, User, Category, ServiceStatus, APIKey, ServiceDependency
 from sqlalchemy import text
-from cron_helper import check_service_job, add_cron_job, scheduler
+from cron_helper import check_service_job, add_cron_job, remove_service_jobs, scheduler
 from flask_cors import CORS
 import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_migrate import Migrate
-from cron_helper import send_discord_alert
+from cron_helper import send_discord_alert, get_dependent_services, find_down_parent
 from jwtUtils import encode_jwt, verify_jwt
+from db_routing import build_binds, read_only
+from profiling import init_profiling, get_report, reset as reset_profiling, is_enabled as profiling_enabled
+from status_store import backfill_intervals, record_status, get_latest_status, get_recent_statuses, get_uptime, get_category_summary, invalidate_summary
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DIST_DIR = os.path.join(BASE_DIR, "dist")
@@ -26,13 +32,47 @@ SQLALCHEMY_DATABASE_URI = (
     f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
     f"@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}?charset=utf8mb4"
 )
+# Danh sách read-replica, phân tách bằng dấu phẩy (để trống = chỉ dùng primary)
+DB_REPLICA_URIS = [
+    uri.strip() for uri in os.getenv("DB_REPLICA_URIS", "").split(",") if uri.strip()
+]
 APP_ENV = os.getenv("APP_ENV", "development")
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
+# Pool của primary dành cho API, probe có pool riêng (bind "probe")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": int(os.getenv("API_DB_POOL_SIZE", 10)),
+    "pool_pre_ping": True,
+}
+app.config['SQLALCHEMY_BINDS'] = build_binds(
+    SQLALCHEMY_DATABASE_URI,
+    DB_REPLICA_URIS,
+    probe_pool_size=int(os.getenv("PROBE_DB_POOL_SIZE", 5)),
+    replica_pool_size=int(os.getenv("REPLICA_DB_POOL_SIZE", 10)),
+    replica_connect_timeout=int(os.getenv("REPLICA_CONNECT_TIMEOUT", 2)),
+)
+app.config['REPLICA_MAX_LAG_SECONDS'] = int(
+    os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+app.config['REPLICA_LAG_CHECK_INTERVAL'] = int(
+    os.getenv("REPLICA_LAG_CHECK_INTERVAL", 10))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['STATUS_STORAGE_MODE'] = os.getenv("STATUS_STORAGE_MODE", "raw")
 app.secret_key = os.getenv("SECRET_KEY", "super-secret-key")
 app.config['SESSION_COOKIE_SECURE'] = (APP_ENV == "production")
 SECRET_KEY = os.getenv("SECRET_KEY", "super-secret-key")
+# Đo thời gian route / SQL / job (bật bằng PROFILING_ENABLED=true)
+app.config['PROFILING_ENABLED'] = os.getenv(
+    "PROFILING_ENABLED", "false").lower() == "true"
+app.config['PROFILING_SLOW_QUERY_MS'] = int(
+    os.getenv("PROFILING_SLOW_QUERY_MS", 200))
+app.config['PROFILING_JOB_SAMPLE_RATE'] = float(
+    os.getenv("PROFILING_JOB_SAMPLE_RATE", 0.05))
+app.config['PROFILING_TOP_N'] = int(os.getenv("PROFILING_TOP_N", 20))
+# Chu kỳ (giây) remote agent tải lại danh sách dịch vụ được giao
+AGENT_REFRESH_INTERVAL = int(os.getenv("AGENT_REFRESH_INTERVAL", 60))
+# Kích thước tối đa (byte) của một batch kết quả sau khi giải nén
+AGENT_MAX_BATCH_BYTES = int(os.getenv("AGENT_MAX_BATCH_BYTES", 10 * 1024 * 1024))
 db.init_app(app)
+init_profiling(app)
 migrate = Migrate(app, db)
 migrate.init_app(app, db)
 
@@ -107,10 +147,20 @@ def get_me():
 # API: Lấy danh sách category
 @app.route("/api/categories", methods=["GET"])
 @login_required
+@read_only
 def get_categories():
     categories = Category.query.all()
     return jsonify([{"id": c.id, "name": c.name} for c in categories])
 
+# API: Tổng hợp trạng thái theo category (up/down/unknown, trạng thái xấu nhất)
+# Đọc từ primary vì kết quả được giữ lâu trong cache
+
+
+@app.route("/api/categories/summary", methods=["GET"])
+@login_required
+def get_categories_summary():
+    return jsonify(get_category_summary())
+
 # API: Thêm category
 
 
@@ -121,6 +171,7 @@ def add_category():
     new_cat = Category(name=data["name"])
     db.session.add(new_cat)
     db.session.commit()
+    invalidate_summary()
     return jsonify({"message": "Category added", "id": new_cat.id}), 201
 
 # API: Sửa category
@@ -133,6 +184,7 @@ def update_category(cat_id):
     data = request.json
     category.name = data["name"]
     db.session.commit()
+    invalidate_summary()
     return jsonify({"message": "Category updated"})
 
 # API: Xoá category (xoá luôn các service liên quan nếu cần)
@@ -144,6 +196,7 @@ def delete_category(cat_id):
     category = Category.query.get_or_404(cat_id)
     db.session.delete(category)
     db.session.commit()
+    invalidate_summary()
     return jsonify({"message": "Category deleted"})
 
 
@@ -152,6 +205,7 @@ def delete_category(cat_id):
 
 @app.route("/api/services", methods=["GET"])
 @login_required
+@read_only
 def get_services():
 
     category_id = request.args.get("category_id")
@@ -173,6 +227,7 @@ def get_services():
             "cookies": s.cookie,
             "timeout": s.timeout,
             "cron": s.cron,
+            "agent": s.agent,
             "category": s.category.name if s.category else None
         })
     return jsonify(result)
@@ -184,6 +239,10 @@ def get_services():
 @login_required
 def add_service():
     data = request.json
+    agent = data.get("agent")
+    if agent and not APIKey.query.filter_by(name=agent).first():
+        return jsonify({"error": f"API key '{agent}' not found"}), 400
+
     new_service = Service(
         name=data["name"],
         url=data["url"],
@@ -192,13 +251,15 @@ def add_service():
         data=data.get("data", {}),
         cookie=data.get("cookies", {}),
         timeout=data.get("timeout", 5),
-        cron=data.get("schedule_time")
+        cron=data.get("schedule_time"),
+        agent=agent
     )
     db.session.add(new_service)
     db.session.commit()
+    invalidate_summary()
 
-    # Gọi luôn cronjob sau khi thêm nếu có cron
-    if new_service.cron:
+    # Gọi luôn cronjob sau khi thêm nếu có cron (trừ khi do remote agent kiểm tra)
+    if new_service.cron and not new_service.agent:
         add_cron_job(new_service, app)
         check_service_job(new_service.id, app=app)
 
@@ -213,6 +274,11 @@ def update_service(service_id):
     service = Service.query.get_or_404(service_id)
     data = request.json
 
+    # Giữ nguyên agent nếu body không gửi trường này (dashboard cũ)
+    agent = data.get("agent", service.agent)
+    if agent and not APIKey.query.filter_by(name=agent).first():
+        return jsonify({"error": f"API key '{agent}' not found"}), 400
+
     service.name = data["name"]
     service.url = data["url"]
     service.category_id = data.get("category_id")
@@ -221,16 +287,15 @@ def update_service(service_id):
     service.cookie = data.get("cookies", {})
     service.timeout = data.get("timeout")
     service.cron = data.get("schedule_time")
+    service.agent = agent
 
     db.session.commit()
+    invalidate_summary()
 
     # Xoá cronjob cũ nếu tồn tại
-    job_id = f"service_{service.id}"
-    existing_job = scheduler.get_job(job_id)
-    if existing_job:
-        scheduler.remove_job(job_id)
+    remove_service_jobs(service.id)
 
-    # Thêm lại cronjob mới nếu có cron
+    # Thêm lại cronjob mới nếu có cron (add_cron_job bỏ qua dịch vụ của agent)
     if service.cron:
         add_cron_job(service, app)
 
@@ -244,10 +309,7 @@ def update_service(service_id):
 def delete_service(service_id):
     service = Service.query.get_or_404(service_id)
 
-    job_id = f"service_{service.id}"
-    existing_job = scheduler.get_job(job_id)
-    if existing_job:
-        scheduler.remove_job(job_id)
+    remove_service_jobs(service.id)
 
     # Xoá status trước (nếu có)
     status = StatusService.query.filter_by(id_service=service.id).first()
@@ -256,6 +318,7 @@ def delete_service(service_id):
 
     db.session.delete(service)
     db.session.commit()
+    invalidate_summary()
 
     return jsonify({"message": f"Đã xoá dịch vụ '{service.name}'"})
 
@@ -279,34 +342,26 @@ def check_service(service_id):
 
 @app.route("/api/services/<int:service_id>/status", methods=["GET"])
 @login_required
+@read_only
 def get_service_status(service_id):
     print(service_id)
     service = Service.query.get_or_404(service_id)
-    status = StatusService.query.filter_by(id_service=service_id).order_by(
-        StatusService.finish_time.desc()).first()
+    status = get_latest_status(
+        service_id, service.category.name if service.category else None)
     if not status:
         return jsonify({"message": "Không có dữ liệu status"}), 404
 
-    return jsonify({
-        "id_service": status.id_service,
-        "name": status.name,
-        'category': service.category.name if service.category else None,
-        "status": status.status.value,
-        "finish_time": status.finish_time.strftime("%Y-%m-%d %H:%M:%S"),
-    })
+    return jsonify(status)
 
 
 @app.route("/api/services/<int:service_id>/statuses", methods=["GET"])
 @login_required
+@read_only
 def get_service_statuses(service_id):
     service = Service.query.get_or_404(service_id)
-    statuses = (
-        StatusService.query
-        .filter_by(id_service=service_id)
-        .order_by(StatusService.finish_time.desc())  # Get latest first
-        .limit(50)
-        .all()
-    )
+    # Oldest → newest
+    statuses = get_recent_statuses(
+        service_id, service.category.name if service.category else None)
 
     if not statuses:
         if service.cron:
@@ -314,24 +369,102 @@ def get_service_statuses(service_id):
         else:
             return jsonify([])
 
-    # Reverse to make finish_time ascending (oldest → newest)
-    statuses = list(reversed(statuses))
+    return jsonify(statuses)
+
+# API: Tỉ lệ uptime của dịch vụ trong N giờ gần nhất (tối đa 1 năm)
+MAX_UPTIME_HOURS = 24 * 365
 
-    return jsonify([
-        {
-            "id": status.id,
-            "id_service": status.id_service,
-            "name": status.name,
-            'category': service.category.name if service.category else None,
-            "status": status.status.value,
-            "finish_time": status.finish_time.strftime("%Y-%m-%d %H:%M:%S"),
-        } for status in statuses
-    ])
+
+@app.route("/api/services/<int:service_id>/uptime", methods=["GET"])
+@login_required
+@read_only
+def get_service_uptime(service_id):
+    Service.query.get_or_404(service_id)
+    hours = request.args.get("hours", 24, type=int)
+    if hours is None or not 1 <= hours <= MAX_UPTIME_HOURS:
+        return jsonify({"error": f"hours must be between 1 and {MAX_UPTIME_HOURS}"}), 400
+    return jsonify(get_uptime(service_id, hours))
+
+# ==== DEPENDENCY CRUD ====
+
+# API: Lấy danh sách phụ thuộc (cha -> dịch vụ con / category con)
+
+
+@app.route("/api/dependencies", methods=["GET"])
+@login_required
+@read_only
+def get_dependencies():
+    dependencies = ServiceDependency.query.all()
+    return jsonify([{
+        "id": d.id,
+        "parent_service_id": d.parent_service_id,
+        "parent": d.parent.name,
+        "child_service_id": d.child_service_id,
+        "child_service": d.child_service.name if d.child_service else None,
+        "child_category_id": d.child_category_id,
+        "child_category": d.child_category.name if d.child_category else None,
+    } for d in dependencies])
+
+# API: Thêm phụ thuộc
+
+
+@app.route("/api/dependencies", methods=["POST"])
+@login_required
+def add_dependency():
+    data = request.json or {}
+    parent_id = data.get("parent_service_id")
+    child_service_id = data.get("child_service_id")
+    child_category_id = data.get("child_category_id")
+
+    if not parent_id or bool(child_service_id) == bool(child_category_id):
+        return jsonify({"error": "parent_service_id and exactly one of child_service_id, child_category_id are required"}), 400
+    if parent_id == child_service_id:
+        return jsonify({"error": "A service cannot depend on itself"}), 400
+    if not db.session.get(Service, parent_id):
+        return jsonify({"error": f"Service with id {parent_id} not found"}), 404
+    if child_service_id and not db.session.get(Service, child_service_id):
+        return jsonify({"error": f"Service with id {child_service_id} not found"}), 404
+    if child_category_id and not db.session.get(Category, child_category_id):
+        return jsonify({"error": f"Category with id {child_category_id} not found"}), 404
+
+    if ServiceDependency.query.filter_by(
+            parent_service_id=parent_id,
+            child_service_id=child_service_id,
+            child_category_id=child_category_id).first():
+        return jsonify({"error": "Dependency already exists"}), 409
+
+    dependency = ServiceDependency(
+        parent_service_id=parent_id,
+        child_service_id=child_service_id,
+        child_category_id=child_category_id
+    )
+    db.session.add(dependency)
+    db.session.commit()
+    return jsonify({"message": "Dependency added", "id": dependency.id}), 201
+
+# API: Xoá phụ thuộc
+
+
+@app.route("/api/dependencies/<int:dependency_id>", methods=["DELETE"])
+@login_required
+def delete_dependency(dependency_id):
+    dependency = ServiceDependency.query.get_or_404(dependency_id)
+    db.session.delete(dependency)
+    db.session.commit()
+    return jsonify({"message": "Dependency deleted"})
 
 # API webhook
 
 
-def jwt_required(f):
+def jwt_required(f=None, api_key=False):
+    """
+    Require a valid JWT bearer token.
+    With api_key=True the token must also still exist in the APIKey table
+    (deleting the key revokes it) and the key is set on request.api_key.
+    """
+    if f is None:
+        return lambda func: jwt_required(func, api_key=api_key)
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get("Authorization", None)
@@ -344,6 +477,12 @@ def jwt_required(f):
         if not result["valid"]:
             return jsonify({"error": result.get("error", "Invalid token")}), 401
 
+        if api_key:
+            key = APIKey.query.filter_by(key=token).first()
+            if not key:
+                return jsonify({"error": "Unknown API key"}), 401
+            request.api_key = key
+
         # You can access payload using g or pass it to the function via kwargs
         request.jwt_payload = result["payload"]
         return f(*args, **kwargs)
@@ -375,24 +514,19 @@ def webhook_handler():
         # Lấy thông tin category nếu có
         category_name = service.category.name if service.category else None
 
-        # Tạo bản ghi status mới
-        status_entry = StatusService(
-            id_service=service.id,
-            name=service.name,
-            status=ServiceStatus[status],  # Sử dụng enum ServiceStatus
-            finish_time=datetime.now()
-        )
-
-        db.session.add(status_entry)
-        db.session.commit()
+        # Lưu trạng thái mới
+        finish_time = datetime.now()
+        record_status(service, ServiceStatus[status], finish_time)
 
         # Gửi thông báo Discord nếu status là DOWN
-        if status == 'DOWN':
+        # (dịch vụ cha đang DOWN -> đã có cảnh báo root cause của dịch vụ cha)
+        if status == 'DOWN' and not find_down_parent(service):
             send_discord_alert(
                 service.name,
                 service.url,
                 "Service reported DOWN via webhook",
-                category_name
+                category_name,
+                [s.name for s in get_dependent_services(service)]
             )
 
         return jsonify({
@@ -400,7 +534,7 @@ def webhook_handler():
             "service_id": service.id,
             "service_name": service.name,
             "status": status,
-            "timestamp": status_entry.finish_time.isoformat(),
+            "timestamp": finish_time.isoformat(),
             "category": category_name
         }), 200
 
@@ -408,11 +542,118 @@ def webhook_handler():
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# API remote agent (xác thực bằng API key)
+
+
+@app.route("/api/agent/assignments", methods=["GET"])
+@jwt_required(api_key=True)
+@read_only
+def get_agent_assignments():
+    services = Service.query.filter_by(agent=request.api_key.name).all()
+    return jsonify({
+        "agent": request.api_key.name,
+        "refresh_interval": AGENT_REFRESH_INTERVAL,
+        "services": [{
+            "id": s.id,
+            "name": s.name,
+            "url": s.url,
+            "method": s.method.value,
+            "data": s.data,
+            "cookies": s.cookie,
+            "timeout": s.timeout,
+            "cron": s.cron,
+        } for s in services if s.cron]
+    }), 200
+
+
+@app.route("/api/agent/results", methods=["POST"])
+@jwt_required(api_key=True)
+def post_agent_results():
+    agent_name = request.api_key.name
+    if (request.content_length or 0) > AGENT_MAX_BATCH_BYTES:
+        return jsonify({"error": "Batch too large"}), 413
+
+    try:
+        body = request.get_data()
+        if request.headers.get("Content-Encoding") == "gzip":
+            # Giải nén có giới hạn để tránh gzip bomb
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decompressor.decompress(body, AGENT_MAX_BATCH_BYTES + 1)
+            if len(body) > AGENT_MAX_BATCH_BYTES:
+                return jsonify({"error": "Batch too large"}), 413
+        data = json.loads(body)
+    except Exception as e:
+        return jsonify({"error": f"Invalid payload: {e}"}), 400
+
+    if not isinstance(data, dict) or not isinstance(data.get("results"), list):
+        return jsonify({"error": "Missing required field: results"}), 400
+
+    tz = pytz.timezone('Asia/Bangkok')
+    services = {
+        s.id: s for s in Service.query.filter_by(agent=agent_name).all()}
+    accepted = []
+    rejected = 0
+
+    try:
+        for item in data["results"]:
+            service = services.get(item.get("service_id"))
+            status = str(item.get("status", "")).upper()
+            try:
+                finish_time = datetime.fromisoformat(item["finish_time"])
+            except (KeyError, TypeError, ValueError):
+                finish_time = None
+
+            if not service or status not in ['UP', 'DOWN'] or not finish_time:
+                rejected += 1
+                continue
+            if finish_time.tzinfo:
+                finish_time = finish_time.astimezone(tz)
+            accepted.append((finish_time, service, status, item))
+
+        # Kết quả lấy từ buffer của agent có thể đến không theo thứ tự
+        accepted.sort(key=lambda r: r[0].replace(tzinfo=None))
+
+        # service_id -> kết quả mới nhất trong batch
+        latest = {}
+        for finish_time, service, status, item in accepted:
+            location = item.get("location") or data.get("location")
+            record_status(service, ServiceStatus[status], finish_time,
+                          agent=agent_name, location=location, commit=False)
+            latest[service.id] = (service, status, item.get("error"), location)
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # Cache có thể đã nhận các kết quả bị rollback
+        invalidate_summary()
+        return jsonify({"error": str(e)}), 500
+
+    # Gửi thông báo Discord sau khi đã lưu: tối đa một cảnh báo cho mỗi dịch vụ,
+    # dựa trên kết quả mới nhất (batch cũ từ spool không gây hàng loạt cảnh báo)
+    for service, status, error, location in latest.values():
+        # Dịch vụ cha đang DOWN -> đã có cảnh báo root cause của dịch vụ cha
+        if status != 'DOWN' or find_down_parent(service):
+            continue
+        send_discord_alert(
+            service.name,
+            service.url,
+            f"[{agent_name}@{location}] {error or 'DOWN'}",
+            service.category.name if service.category else None,
+            [s.name for s in get_dependent_services(service)]
+        )
+
+    return jsonify({
+        "message": "Results recorded",
+        "accepted": len(accepted),
+        "rejected": rejected
+    }), 200
+
 # API key with JWT
 
 
 @app.route("/api/api-key", methods=["GET"])
 @login_required
+@read_only
 def get_api_keys():
     api_keys = APIKey.query.all()
     result = []
@@ -466,6 +707,26 @@ def delete_api_key(key_id):
 
     return jsonify({"message": f"API key with id {key_id} deleted"}), 200
 
+# API profiling
+
+
+@app.route("/api/debug/profile", methods=["GET"])
+@login_required
+def get_profile():
+    if not profiling_enabled():
+        return jsonify({"error": "Profiling is disabled"}), 404
+    top_n = request.args.get("top", type=int)
+    return jsonify(get_report(top_n)), 200
+
+
+@app.route("/api/debug/profile", methods=["DELETE"])
+@login_required
+def delete_profile():
+    if not profiling_enabled():
+        return jsonify({"error": "Profiling is disabled"}), 404
+    reset_profiling()
+    return jsonify({"message": "Profiling data reset"}), 200
+
 # TODO :Check for db
 
 
@@ -483,6 +744,27 @@ def wait_for_db():
             time.sleep(2)
     return False
 
+# TODO: Sync enum columns (flask db migrate không phát hiện giá trị enum mới)
+
+
+def upgrade_status_enum():
+    """Add missing ServiceStatus values to the MySQL status enum columns"""
+    if db.engine.dialect.name != "mysql":
+        return
+
+    values = ",".join(f"'{s.name}'" for s in ServiceStatus)
+    for table in ("status_service", "status_interval"):
+        column_type = db.session.execute(text(
+            "SELECT COLUMN_TYPE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = 'status'"
+        ), {"table": table}).scalar()
+
+        if column_type and any(f"'{s.name}'" not in column_type for s in ServiceStatus):
+            print(f"Updating {table}.status enum...")
+            db.session.execute(
+                text(f"ALTER TABLE {table} MODIFY status ENUM({values}) NOT NULL"))
+            db.session.commit()
+
 # TODO: Create 1 user only
 
 
@@ -507,9 +789,12 @@ def init_app():
 
             if APP_ENV == "development":
                 print("Creating tables...")
-                db.create_all()
+                db.create_all(bind_key=None)
                 print("Tables created.")
 
+            upgrade_status_enum()
+            backfill_intervals()
+
             scheduler.start()
 
             create_user(
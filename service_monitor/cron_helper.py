@@ -1,29 +1,96 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
-from flask import current_app
+from flask import current_app, g
 from datetime import datetime
 import requests
 import os
-from models import db, Service, StatusService, ServiceStatus, HttpMethod, Category
+from sqlalchemy import or_
+from models import Service, ServiceStatus, HttpMethod, Category, ServiceDependency
+from status_store import record_status, latest_status
+from db_routing import ROUTE_PROBE
+from profiling import profile_job
 
 scheduler = BackgroundScheduler()
 DISCORD_WEBHOOK_URL = f"{os.getenv('DISCORD_WEBHOOK')}"
 
 
-def send_discord_alert(service_name, service_url, error_msg, category_name=None):
+def send_discord_alert(service_name, service_url, error_msg, category_name=None, affected_services=None):
     if category_name:
         content = f"❗ **Dịch vụ đang DOWN**\n > **Category: ** {category_name} \n > **Dịch vụ: **{service_name}\n > **Trạng thái: **DOWN.\n > **URL: ** {service_url}\n > **Lỗi: ** `{error_msg}`"
     else:
         content = f"❗ **Dịch vụ đang DOWN**\n > **Dịch vụ: **{service_name}\n > **Trạng thái: **DOWN.\n > **URL: ** {service_url}\n > **Lỗi: ** `{error_msg}`"
+    # Gộp các dịch vụ phụ thuộc vào cùng một cảnh báo (root cause)
+    if affected_services:
+        content += f"\n > **Ảnh hưởng ({len(affected_services)}): ** {', '.join(affected_services)}"
     try:
         requests.post(DISCORD_WEBHOOK_URL, json={"content": content})
     except Exception as ex:
         print(f"[ERROR] Gửi Discord thất bại: {ex}")
 
 
+def get_parent_services(service):
+    """Services declared as parent of this service or of its category"""
+    conditions = [ServiceDependency.child_service_id == service.id]
+    if service.category_id:
+        conditions.append(
+            ServiceDependency.child_category_id == service.category_id)
+
+    dependencies = ServiceDependency.query.filter(
+        or_(*conditions),
+        ServiceDependency.parent_service_id != service.id
+    ).all()
+    return [dep.parent for dep in dependencies]
+
+
+def get_dependent_services(service):
+    """Services (direct and transitive) that are skipped while this service is DOWN"""
+    dependents = {}
+    pending = [service]
+    while pending:
+        current = pending.pop()
+        children = []
+        for dep in ServiceDependency.query.filter_by(parent_service_id=current.id).all():
+            if dep.child_service:
+                children.append(dep.child_service)
+            if dep.child_category:
+                children.extend(dep.child_category.services)
+        for child in children:
+            if child.id != service.id and child.id not in dependents:
+                dependents[child.id] = child
+                pending.append(child)
+    return list(dependents.values())
+
+
+def find_down_parent(service, visited=None):
+    """
+    Return the root parent that is DOWN, or None.
+    An UNREACHABLE parent only counts if one of its own parents is still
+    DOWN, so a dependency cycle can never suppress probing forever.
+    """
+    visited = visited or {service.id}
+    for parent in get_parent_services(service):
+        if parent.id in visited:
+            continue
+        visited.add(parent.id)
+
+        entry = latest_status(parent.id)
+        if not entry:
+            continue
+        if entry.status == ServiceStatus.DOWN:
+            return parent
+        if entry.status == ServiceStatus.UNREACHABLE:
+            root = find_down_parent(parent, visited)
+            if root:
+                return root
+    return None
+
+
+@profile_job
 def check_service_job(service_id, app):
     with app.app_context():
+        # Dùng pool riêng của probe để không tranh connection với API
+        g.db_route = ROUTE_PROBE
         service = Service.query.get(service_id)
         if not service:
             return None
@@ -35,9 +102,22 @@ def check_service_job(service_id, app):
             if category:
                 category_name = category.name
 
+        # Set timezone to UTC+7
+        tz = pytz.timezone('Asia/Bangkok')
+
+        # Dịch vụ cha đang DOWN -> bỏ qua, không gửi cảnh báo riêng
+        parent = find_down_parent(service)
+        if parent:
+            record_status(service, ServiceStatus.UNREACHABLE, datetime.now(tz))
+            return {
+                "name": service.name,
+                "status": ServiceStatus.UNREACHABLE.value,
+                "category": category_name,
+                "parent": parent.name,
+                "error": f"Parent service '{parent.name}' is DOWN"
+            }
+
         try:
-            # Set timezone to UTC+7
-            tz = pytz.timezone('Asia/Bangkok')
             start = datetime.now(tz)
 
             method = service.method
@@ -64,21 +144,15 @@ def check_service_job(service_id, app):
             # Determine service status
             if 400 <= response.status_code < 600:
                 status = ServiceStatus.DOWN
-                send_discord_alert(service.name, service.url, f"HTTP {response.status_code} - {response.text}", category_name)
+                send_discord_alert(service.name, service.url, f"HTTP {response.status_code} - {response.text}", category_name,
+                                   [s.name for s in get_dependent_services(service)])
             else:
                 status = ServiceStatus.UP
 
             finish_time = datetime.now(tz)
 
             # Log status to DB
-            status_entry = StatusService(
-                id_service=service.id,
-                name=service.name,
-                status=status,
-                finish_time=finish_time
-            )
-            db.session.add(status_entry)
-            db.session.commit()
+            record_status(service, status, finish_time)
 
             return {
                 "name": service.name,
@@ -92,16 +166,10 @@ def check_service_job(service_id, app):
         except Exception as e:
             finish_time = datetime.now(tz)
 
-            status_entry = StatusService(
-                id_service=service.id,
-                name=service.name,
-                status=ServiceStatus.DOWN,
-                finish_time=finish_time
-            )
-            db.session.add(status_entry)
-            db.session.commit()
+            record_status(service, ServiceStatus.DOWN, finish_time)
 
-            send_discord_alert(service.name, service.url, str(e), category_name)
+            send_discord_alert(service.name, service.url, str(e), category_name,
+                               [s.name for s in get_dependent_services(service)])
             return {
                 "name": service.name,
                 "status": "DOWN",
@@ -110,14 +178,27 @@ def check_service_job(service_id, app):
             }
 
 
+def remove_service_jobs(service_id):
+    """Remove every cronjob of a service, whatever name/method/url it was added with"""
+    prefix = f"service_{service_id}:"
+    for job in scheduler.get_jobs():
+        if job.id.startswith(prefix):
+            print(f"REMOVE {job.id}")
+            scheduler.remove_job(job.id)
+
+
 def add_cron_job(service, app):
+    # Job id chứa name/url cũ -> xoá theo prefix để không còn job cũ chạy song song
+    remove_service_jobs(service.id)
+
     if not service.cron:
         return
 
     job_id = f"service_{service.id}:{service.name}:{service.method.value}:{service.url}"
-    if scheduler.get_job(job_id):
-        print(f"REMOVE {job_id}")
-        scheduler.remove_job(job_id)
+
+    # Dịch vụ do remote agent kiểm tra -> server không chạy cronjob
+    if service.agent:
+        return
 
     cron_parts = service.cron.strip().split()
     if len(cron_parts) == 5:
@@ -0,0 +1,126 @@
+import random
+import threading
+import time
+from functools import wraps
+from flask import g, has_app_context, current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+
+# Bind key cho đường probe (cùng DB primary nhưng pool riêng)
+PROBE_BIND = "probe"
+# Bind key cho các read-replica: replica_0, replica_1, ...
+REPLICA_BIND_PREFIX = "replica_"
+
+ROUTE_PROBE = "probe"
+ROUTE_READ = "read"
+
+# bind_key -> (thời điểm kiểm tra, replica có dùng được không)
+_replica_health = {}
+_replica_health_lock = threading.Lock()
+
+
+def build_binds(primary_uri, replica_uris, probe_pool_size=5, replica_pool_size=10,
+                replica_connect_timeout=2):
+    """Build the SQLALCHEMY_BINDS config for the probe pool and the replicas"""
+    binds = {
+        PROBE_BIND: {
+            "url": primary_uri,
+            "pool_size": probe_pool_size,
+            "pool_pre_ping": True,
+        }
+    }
+    for i, uri in enumerate(replica_uris):
+        binds[f"{REPLICA_BIND_PREFIX}{i}"] = {
+            "url": uri,
+            "pool_size": replica_pool_size,
+            "pool_pre_ping": True,
+            # Replica chết không được làm treo request quá lâu
+            "connect_args": {"connect_timeout": replica_connect_timeout},
+        }
+    return binds
+
+
+def _replica_lag(engine):
+    """Return replication lag in seconds, None if replication is not running"""
+    with engine.connect() as conn:
+        try:
+            row = conn.execute(text("SHOW REPLICA STATUS")).mappings().first()
+        except Exception:
+            # MySQL < 8.0.22
+            row = conn.execute(text("SHOW SLAVE STATUS")).mappings().first()
+
+    if row is None:
+        # Server không chạy replication -> không biết độ trễ, dùng primary
+        return None
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return None if lag is None else int(lag)
+
+
+def _is_replica_healthy(key, engine):
+    check_interval = current_app.config.get("REPLICA_LAG_CHECK_INTERVAL", 10)
+    max_lag = current_app.config.get("REPLICA_MAX_LAG_SECONDS", 5)
+    now = time.monotonic()
+
+    with _replica_health_lock:
+        cached = _replica_health.get(key)
+        if cached and now - cached[0] < check_interval:
+            return cached[1]
+
+    try:
+        lag = _replica_lag(engine)
+        healthy = lag is not None and lag <= max_lag
+        if not healthy:
+            print(f"[WARN] Replica {key} lag {lag}s, fallback to primary")
+    except Exception as e:
+        print(f"[WARN] Replica {key} unavailable, fallback to primary: {e}")
+        healthy = False
+
+    with _replica_health_lock:
+        _replica_health[key] = (now, healthy)
+    return healthy
+
+
+def _pick_replica(engines):
+    replicas = [
+        (key, engine) for key, engine in engines.items()
+        if key and key.startswith(REPLICA_BIND_PREFIX)
+    ]
+    random.shuffle(replicas)
+    for key, engine in replicas:
+        if _is_replica_healthy(key, engine):
+            return engine
+    return None
+
+
+class RoutingSession(Session):
+    """
+    Session that sends read-only API handlers to a healthy replica and the
+    probe job to its own pool. Everything else, and every flush, uses the
+    primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            route = g.get("db_route")
+            engines = self._db.engines
+
+            if route == ROUTE_PROBE and PROBE_BIND in engines:
+                return engines[PROBE_BIND]
+
+            if route == ROUTE_READ and not self._flushing:
+                # Chọn replica một lần cho cả request để dữ liệu nhất quán
+                if "db_replica" not in g:
+                    g.db_replica = _pick_replica(engines)
+                if g.db_replica is not None:
+                    return g.db_replica
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(f):
+    """Route the DB queries of this handler to a read-replica"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_route = ROUTE_READ
+        return f(*args, **kwargs)
+    return decorated_function
@@ -2,9 +2,10 @@ from flask import Flask, request, jsonify, render_template
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import Enum as PgEnum
 import enum
+from db_routing import RoutingSession
 
-# Khởi tạo đối tượng SQLAlchemy
-db = SQLAlchemy()
+# Khởi tạo đối tượng SQLAlchemy (session tự chọn primary / replica / probe pool)
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # ENUM cho phương thức HTTP
 
@@ -22,6 +23,8 @@ class HttpMethod(enum.Enum):
 class ServiceStatus(enum.Enum):
     UP = "UP"
     DOWN = "DOWN"
+    # Không kiểm tra vì dịch vụ cha đang DOWN
+    UNREACHABLE = "UNREACHABLE"
 
 # Bảng Service
 
@@ -35,6 +38,8 @@ class Service(db.Model):
     cookie = db.Column(db.JSON, nullable=True)
     cron = db.Column(db.String(20), nullable=True)
     timeout = db.Column(db.Integer, default=5)
+    # Tên API key của remote agent kiểm tra dịch vụ này (None = server tự kiểm tra)
+    agent = db.Column(db.String(100), nullable=True)
     category_id = db.Column(db.Integer, db.ForeignKey(
         'category.id', ondelete='SET NULL'), nullable=True)
     # Quan hệ đến StatusService
@@ -44,11 +49,24 @@ class Service(db.Model):
         cascade='all, delete-orphan',
         passive_deletes=True  # Cho phép ON DELETE CASCADE hoạt động
     )
+    # Quan hệ đến StatusInterval (chế độ lưu theo khoảng trạng thái)
+    intervals = db.relationship(
+        'StatusInterval',
+        backref='service',
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    )
 
 # Bảng StatusService (lưu kết quả kiểm tra)
 
 
 class StatusService(db.Model):
+    # Phục vụ truy vấn trạng thái mới nhất của từng dịch vụ
+    __table_args__ = (
+        db.Index('ix_status_service_service_finish',
+                 'id_service', 'finish_time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     id_service = db.Column(
         db.Integer,
@@ -58,6 +76,34 @@ class StatusService(db.Model):
     name = db.Column(db.String(255), nullable=False)
     status = db.Column(PgEnum(ServiceStatus), nullable=False)
     finish_time = db.Column(db.DateTime, nullable=False)
+    # Nguồn kết quả: None = server, ngược lại là remote agent và vị trí
+    agent = db.Column(db.String(100), nullable=True)
+    location = db.Column(db.String(100), nullable=True)
+
+# Bảng StatusInterval (chỉ lưu khi trạng thái thay đổi - run-length)
+# Mỗi dòng là một khoảng liên tục có cùng trạng thái:
+# started_at = lần kiểm tra đầu tiên, last_seen_at = lần kiểm tra gần nhất
+
+
+class StatusInterval(db.Model):
+    __table_args__ = (
+        db.Index('ix_status_interval_service_started',
+                 'id_service', 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    id_service = db.Column(
+        db.Integer,
+        db.ForeignKey('service.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    name = db.Column(db.String(255), nullable=False)
+    status = db.Column(PgEnum(ServiceStatus), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    last_seen_at = db.Column(db.DateTime, nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False, default=1)
+    agent = db.Column(db.String(100), nullable=True)
+    location = db.Column(db.String(100), nullable=True)
 
 
 class User(db.Model):
@@ -76,6 +122,33 @@ class Category(db.Model):
         'Service', backref='category', cascade="all, delete", passive_deletes=True)
 
 
+# Bảng ServiceDependency: dịch vụ cha -> dịch vụ con hoặc cả một category
+# Khi dịch vụ cha DOWN, dịch vụ con không được kiểm tra (UNREACHABLE)
+
+
+class ServiceDependency(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    parent_service_id = db.Column(
+        db.Integer,
+        db.ForeignKey('service.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    child_service_id = db.Column(
+        db.Integer,
+        db.ForeignKey('service.id', ondelete='CASCADE'),
+        nullable=True
+    )
+    child_category_id = db.Column(
+        db.Integer,
+        db.ForeignKey('category.id', ondelete='CASCADE'),
+        nullable=True
+    )
+    parent = db.relationship('Service', foreign_keys=[parent_service_id])
+    child_service = db.relationship(
+        'Service', foreign_keys=[child_service_id])
+    child_category = db.relationship('Category')
+
+
 class APIKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -0,0 +1,259 @@
+import cProfile
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import wraps
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Giới hạn số câu SQL khác nhau được thống kê để tránh tốn bộ nhớ
+MAX_TRACKED_STATEMENTS = 500
+
+_config = {
+    "enabled": False,
+    "slow_query_ms": 200,
+    "job_sample_rate": 0.05,
+    "top_n": 20,
+}
+_lock = threading.Lock()
+# Chỉ một job được cProfile tại một thời điểm
+_job_profiler_lock = threading.Lock()
+# Bộ đếm của request / job đang chạy trên thread hiện tại
+_local = threading.local()
+
+
+def _empty_stats():
+    return {
+        "routes": {},
+        "statements": {},
+        "slow_statements": deque(maxlen=_config["top_n"]),
+        "jobs": {},
+        "job_profile": None,
+        "since": datetime.now(),
+    }
+
+
+_stats = _empty_stats()
+
+
+def _start_collector(name):
+    previous = getattr(_local, "collector", None)
+    _local.collector = {
+        "name": name,
+        "start": time.perf_counter(),
+        "queries": 0,
+        "query_ms": 0.0,
+    }
+    return previous
+
+
+def _finish_collector(previous):
+    collector = _local.collector
+    _local.collector = previous
+    collector["elapsed_ms"] = (time.perf_counter() - collector["start"]) * 1000
+    return collector
+
+
+def _add_timing(table, collector):
+    entry = table.setdefault(collector["name"], {
+        "count": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "queries": 0,
+        "max_queries": 0,
+        "query_ms": 0.0,
+    })
+    entry["count"] += 1
+    entry["total_ms"] += collector["elapsed_ms"]
+    entry["max_ms"] = max(entry["max_ms"], collector["elapsed_ms"])
+    entry["queries"] += collector["queries"]
+    entry["max_queries"] = max(entry["max_queries"], collector["queries"])
+    entry["query_ms"] += collector["query_ms"]
+
+
+# ==== Flask hooks ====
+
+
+def _before_request():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    request._profiling_previous = _start_collector(f"{request.method} {rule}")
+
+
+def _teardown_request(exc):
+    if hasattr(request, "_profiling_previous"):
+        collector = _finish_collector(request._profiling_previous)
+        with _lock:
+            _add_timing(_stats["routes"], collector)
+
+
+# ==== SQLAlchemy hooks ====
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Lưu trên context của câu lệnh (bị huỷ cùng câu lệnh, kể cả khi lỗi)
+    if context is not None:
+        context._profiling_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_profiling_start", None)
+    if start is None:
+        return
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    collector = getattr(_local, "collector", None)
+    name = None
+    if collector is not None:
+        collector["queries"] += 1
+        collector["query_ms"] += elapsed_ms
+        name = collector["name"]
+
+    with _lock:
+        statements = _stats["statements"]
+        entry = statements.get(statement)
+        if entry is None and len(statements) < MAX_TRACKED_STATEMENTS:
+            entry = statements[statement] = {
+                "count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        if entry is not None:
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+        if elapsed_ms >= _config["slow_query_ms"]:
+            _stats["slow_statements"].append({
+                "statement": statement,
+                "ms": round(elapsed_ms, 2),
+                "source": name,
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            })
+
+
+# ==== Job profiling ====
+
+
+def profile_job(f):
+    """Time every run of a scheduler job and cProfile a sample of them"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not _config["enabled"]:
+            return f(*args, **kwargs)
+
+        previous = _start_collector(f.__name__)
+        profiler = None
+        if random.random() < _config["job_sample_rate"] and \
+                _job_profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+
+        try:
+            if profiler is not None:
+                return profiler.runcall(f, *args, **kwargs)
+            return f(*args, **kwargs)
+        finally:
+            collector = _finish_collector(previous)
+            if profiler is not None:
+                _job_profiler_lock.release()
+            with _lock:
+                _add_timing(_stats["jobs"], collector)
+                if profiler is not None:
+                    if _stats["job_profile"] is None:
+                        _stats["job_profile"] = pstats.Stats(profiler)
+                    else:
+                        _stats["job_profile"].add(profiler)
+    return decorated_function
+
+
+# ==== Report ====
+
+
+def _timing_table(table, top_n):
+    rows = [
+        {
+            "name": name,
+            "count": entry["count"],
+            "total_ms": round(entry["total_ms"], 2),
+            "avg_ms": round(entry["total_ms"] / entry["count"], 2),
+            "max_ms": round(entry["max_ms"], 2),
+            "avg_queries": round(entry["queries"] / entry["count"], 2),
+            "max_queries": entry["max_queries"],
+            "query_ms": round(entry["query_ms"], 2),
+        }
+        for name, entry in table.items()
+    ]
+    rows.sort(key=lambda row: row["total_ms"], reverse=True)
+    return rows[:top_n]
+
+
+def _profile_table(stats, top_n):
+    if stats is None:
+        return []
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            "function": f"{filename}:{line}({func})",
+            "calls": nc,
+            "self_ms": round(tt * 1000, 2),
+            "cumulative_ms": round(ct * 1000, 2),
+        })
+    rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return rows[:top_n]
+
+
+def get_report(top_n=None):
+    top_n = top_n or _config["top_n"]
+    with _lock:
+        statements = sorted(
+            (
+                {
+                    "statement": statement,
+                    "count": entry["count"],
+                    "total_ms": round(entry["total_ms"], 2),
+                    "avg_ms": round(entry["total_ms"] / entry["count"], 2),
+                    "max_ms": round(entry["max_ms"], 2),
+                }
+                for statement, entry in _stats["statements"].items()
+            ),
+            key=lambda row: row["total_ms"],
+            reverse=True,
+        )[:top_n]
+
+        return {
+            "since": _stats["since"].strftime("%Y-%m-%d %H:%M:%S"),
+            "routes": _timing_table(_stats["routes"], top_n),
+            "statements": statements,
+            "slow_statements": list(_stats["slow_statements"])[::-1],
+            "jobs": _timing_table(_stats["jobs"], top_n),
+            "job_profile": _profile_table(_stats["job_profile"], top_n),
+        }
+
+
+def reset():
+    global _stats
+    with _lock:
+        _stats = _empty_stats()
+
+
+def is_enabled():
+    return _config["enabled"]
+
+
+def init_profiling(app):
+    """Register the request and SQL hooks when PROFILING_ENABLED is set"""
+    if not app.config.get("PROFILING_ENABLED"):
+        return
+
+    _config["enabled"] = True
+    _config["slow_query_ms"] = app.config.get("PROFILING_SLOW_QUERY_MS", 200)
+    _config["job_sample_rate"] = app.config.get(
+        "PROFILING_JOB_SAMPLE_RATE", 0.05)
+    _config["top_n"] = app.config.get("PROFILING_TOP_N", 20)
+    reset()
+
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    print("Profiling enabled.")
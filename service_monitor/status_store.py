@@ -0,0 +1,426 @@
+from datetime import datetime, timedelta
+import threading
+import pytz
+from flask import current_app
+from sqlalchemy import func, and_
+from models import db, Service, Category, StatusService, StatusInterval, ServiceStatus
+
+# Chế độ lưu lịch sử trạng thái:
+#  - "raw": mỗi lần kiểm tra là một dòng StatusService (mặc định)
+#  - "interval": chỉ lưu khoảng trạng thái (StatusInterval), một dòng mới
+#    chỉ được thêm khi trạng thái thay đổi
+STORAGE_MODE_RAW = "raw"
+STORAGE_MODE_INTERVAL = "interval"
+
+# Cache tổng hợp theo category:
+# service_id -> (category_id, trạng thái mới nhất, thời điểm của kết quả đó)
+# Được nạp một lần từ DB rồi cập nhật dần mỗi khi có kết quả mới.
+# Trong lúc đang nạp, kết quả mới được giữ ở "pending" rồi gộp vào sau.
+_summary_cache = {
+    "services": None,
+    "categories": None,
+    "loading": False,
+    "pending": {},
+    "generation": 0,
+}
+_summary_lock = threading.Lock()
+# Chỉ một request nạp cache tại một thời điểm
+_summary_load_lock = threading.Lock()
+
+
+def storage_mode():
+    mode = current_app.config.get("STATUS_STORAGE_MODE", STORAGE_MODE_RAW)
+    if mode not in (STORAGE_MODE_RAW, STORAGE_MODE_INTERVAL):
+        return STORAGE_MODE_RAW
+    return mode
+
+
+def record_status(service, status, finish_time, agent=None, location=None, commit=True):
+    """Save one check result for a service (a new interval starts when the status or its source changes)"""
+    if storage_mode() == STORAGE_MODE_INTERVAL:
+        entry = (
+            StatusInterval.query
+            .filter_by(id_service=service.id)
+            .order_by(StatusInterval.started_at.desc(), StatusInterval.id.desc())
+            .with_for_update()
+            .first()
+        )
+        if entry and entry.status == status and \
+                (entry.agent, entry.location) == (agent, location):
+            # Cùng trạng thái -> kéo dài khoảng đang mở
+            entry.last_seen_at = finish_time
+            entry.sample_count += 1
+            entry.name = service.name
+        else:
+            entry = StatusInterval(
+                id_service=service.id,
+                name=service.name,
+                status=status,
+                started_at=finish_time,
+                last_seen_at=finish_time,
+                sample_count=1,
+                agent=agent,
+                location=location
+            )
+            db.session.add(entry)
+    else:
+        entry = StatusService(
+            id_service=service.id,
+            name=service.name,
+            status=status,
+            finish_time=finish_time,
+            agent=agent,
+            location=location
+        )
+        db.session.add(entry)
+
+    if commit:
+        db.session.commit()
+
+    _update_summary(service, status, finish_time)
+    return entry
+
+
+def backfill_intervals(batch_size=1000):
+    """
+    Convert the raw history of services that have no interval yet, so that
+    switching to interval mode keeps the existing StatusService history.
+    Called at startup; services that already have intervals are skipped.
+    """
+    if storage_mode() != STORAGE_MODE_INTERVAL:
+        return
+
+    service_ids = [
+        service_id for (service_id,) in
+        db.session.query(StatusService.id_service).distinct()
+        .filter(~StatusService.id_service.in_(
+            db.session.query(StatusInterval.id_service)))
+        .all()
+    ]
+
+    for service_id in service_ids:
+        current = None
+        rows = (
+            StatusService.query
+            .filter_by(id_service=service_id)
+            .order_by(StatusService.finish_time.asc(), StatusService.id.asc())
+            .yield_per(batch_size)
+        )
+        for row in rows:
+            if current and current.status == row.status and \
+                    (current.agent, current.location) == (row.agent, row.location):
+                current.last_seen_at = row.finish_time
+                current.sample_count += 1
+                current.name = row.name
+            else:
+                current = StatusInterval(
+                    id_service=service_id,
+                    name=row.name,
+                    status=row.status,
+                    started_at=row.finish_time,
+                    last_seen_at=row.finish_time,
+                    sample_count=1,
+                    agent=row.agent,
+                    location=row.location
+                )
+                db.session.add(current)
+        db.session.commit()
+        print(f"Backfilled status intervals for service {service_id}")
+
+
+def _serialize(entry, category_name):
+    if isinstance(entry, StatusInterval):
+        result = {
+            "id": entry.id,
+            "id_service": entry.id_service,
+            "name": entry.name,
+            "category": category_name,
+            "status": entry.status.value,
+            "finish_time": entry.last_seen_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "started_at": entry.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "sample_count": entry.sample_count,
+        }
+    else:
+        result = {
+            "id": entry.id,
+            "id_service": entry.id_service,
+            "name": entry.name,
+            "category": category_name,
+            "status": entry.status.value,
+            "finish_time": entry.finish_time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    if entry.agent:
+        result["agent"] = entry.agent
+        result["location"] = entry.location
+    return result
+
+
+def latest_status(service_id):
+    if storage_mode() == STORAGE_MODE_INTERVAL:
+        return (
+            StatusInterval.query
+            .filter_by(id_service=service_id)
+            .order_by(StatusInterval.started_at.desc(), StatusInterval.id.desc())
+            .first()
+        )
+    return (
+        StatusService.query
+        .filter_by(id_service=service_id)
+        .order_by(StatusService.finish_time.desc(), StatusService.id.desc())
+        .first()
+    )
+
+
+def get_latest_status(service_id, category_name=None):
+    entry = latest_status(service_id)
+    if not entry:
+        return None
+    return _serialize(entry, category_name)
+
+
+def get_recent_statuses(service_id, category_name=None, limit=50):
+    """Return the latest `limit` entries, oldest first"""
+    if storage_mode() == STORAGE_MODE_INTERVAL:
+        query = (
+            StatusInterval.query
+            .filter_by(id_service=service_id)
+            .order_by(StatusInterval.started_at.desc(), StatusInterval.id.desc())
+        )
+    else:
+        query = (
+            StatusService.query
+            .filter_by(id_service=service_id)
+            .order_by(StatusService.finish_time.desc(), StatusService.id.desc())
+        )
+
+    entries = list(reversed(query.limit(limit).all()))
+    return [_serialize(entry, category_name) for entry in entries]
+
+
+def _segments(service_id, since):
+    """
+    Yield (status, start, end) segments covering the history after `since`.
+    A status is considered to hold until the next sample with a different
+    status, so raw rows and intervals give the same result. The last entry
+    before `since` is included and clipped, so both measure the same window.
+    """
+    if storage_mode() == STORAGE_MODE_INTERVAL:
+        previous = (
+            StatusInterval.query
+            .filter(StatusInterval.id_service == service_id,
+                    StatusInterval.started_at < since)
+            .order_by(StatusInterval.started_at.desc(), StatusInterval.id.desc())
+            .first()
+        )
+        intervals = (
+            StatusInterval.query
+            .filter(StatusInterval.id_service == service_id,
+                    StatusInterval.started_at >= since)
+            .order_by(StatusInterval.started_at.asc(), StatusInterval.id.asc())
+            .all()
+        )
+        if previous:
+            intervals.insert(0, previous)
+        for i, interval in enumerate(intervals):
+            if i + 1 < len(intervals):
+                end = intervals[i + 1].started_at
+            else:
+                end = interval.last_seen_at
+            yield interval.status, max(interval.started_at, since), end
+    else:
+        previous = (
+            StatusService.query
+            .filter(StatusService.id_service == service_id,
+                    StatusService.finish_time < since)
+            .order_by(StatusService.finish_time.desc(), StatusService.id.desc())
+            .first()
+        )
+        rows = (
+            StatusService.query
+            .filter(StatusService.id_service == service_id,
+                    StatusService.finish_time >= since)
+            .order_by(StatusService.finish_time.asc(), StatusService.id.asc())
+            .all()
+        )
+        if previous:
+            rows.insert(0, previous)
+        for i, row in enumerate(rows):
+            end = rows[i + 1].finish_time if i + 1 < len(rows) else row.finish_time
+            yield row.status, max(row.finish_time, since), end
+
+
+def get_uptime(service_id, hours=24):
+    # Cùng giờ địa phương (UTC+7) với thời điểm probe lưu vào DB
+    now = datetime.now(pytz.timezone('Asia/Bangkok')).replace(tzinfo=None)
+    since = now - timedelta(hours=hours)
+    up_seconds = 0.0
+    down_seconds = 0.0
+    # Không được kiểm tra vì dịch vụ cha DOWN -> không tính vào uptime
+    unreachable_seconds = 0.0
+
+    for status, start, end in _segments(service_id, since):
+        duration = max((end - start).total_seconds(), 0)
+        if status == ServiceStatus.UP:
+            up_seconds += duration
+        elif status == ServiceStatus.UNREACHABLE:
+            unreachable_seconds += duration
+        else:
+            down_seconds += duration
+
+    total = up_seconds + down_seconds
+    return {
+        "id_service": service_id,
+        "hours": hours,
+        "up_seconds": round(up_seconds),
+        "down_seconds": round(down_seconds),
+        "unreachable_seconds": round(unreachable_seconds),
+        "uptime": round(up_seconds * 100 / total, 2) if total else None,
+    }
+
+
+# ==== Category summary ====
+
+# Thứ tự từ tốt đến xấu, dùng để chọn worst_status
+_SEVERITY = ["UP", "UNKNOWN", "UNREACHABLE", "DOWN"]
+
+
+def _empty_summary(category_id, name):
+    return {
+        "category_id": category_id,
+        "category": name,
+        "total": 0,
+        "up": 0,
+        "down": 0,
+        "unreachable": 0,
+        "unknown": 0,
+        "worst_status": None,
+    }
+
+
+def _result_time(value):
+    # DB lưu DateTime không có timezone (giờ địa phương)
+    return value.replace(tzinfo=None) if value else None
+
+
+def _newer(current, candidate):
+    """Keep whichever cached entry has the latest result time"""
+    if current is None or current[2] is None:
+        return candidate
+    return candidate if candidate[2] >= current[2] else current
+
+
+def _update_summary(service, status, finish_time):
+    candidate = (service.category_id, status, _result_time(finish_time))
+    with _summary_lock:
+        services = _summary_cache["services"]
+        if services is not None:
+            services[service.id] = _newer(services.get(service.id), candidate)
+        elif _summary_cache["loading"]:
+            pending = _summary_cache["pending"]
+            pending[service.id] = _newer(pending.get(service.id), candidate)
+
+
+def invalidate_summary():
+    """Drop the cached summary, call it when services or categories change"""
+    with _summary_lock:
+        _summary_cache["services"] = None
+        _summary_cache["categories"] = None
+        _summary_cache["pending"] = {}
+        _summary_cache["generation"] += 1
+
+
+def _load_summary():
+    """Load the latest status of every service with one grouped query"""
+    if storage_mode() == STORAGE_MODE_INTERVAL:
+        model, time_column, seen_column = \
+            StatusInterval, StatusInterval.started_at, StatusInterval.last_seen_at
+    else:
+        model, time_column, seen_column = \
+            StatusService, StatusService.finish_time, StatusService.finish_time
+
+    latest = (
+        db.session.query(
+            model.id_service.label("id_service"),
+            func.max(time_column).label("latest_time"))
+        .group_by(model.id_service)
+        .subquery()
+    )
+    rows = (
+        db.session.query(Service.id, Service.category_id, model.status, seen_column)
+        .outerjoin(latest, latest.c.id_service == Service.id)
+        .outerjoin(model, and_(
+            model.id_service == latest.c.id_service,
+            time_column == latest.c.latest_time))
+        # DATETIME chỉ lưu đến giây -> dòng có id lớn nhất được giữ lại
+        .order_by(model.id)
+        .all()
+    )
+
+    services = {
+        service_id: (category_id, status, seen_at)
+        for service_id, category_id, status, seen_at in rows
+    }
+    categories = {c.id: c.name for c in db.session.query(
+        Category.id, Category.name).all()}
+    return services, categories
+
+
+def _cached_summary():
+    with _summary_lock:
+        if _summary_cache["services"] is not None:
+            return _summary_cache["services"].copy(), _summary_cache["categories"]
+
+    with _summary_load_lock:
+        with _summary_lock:
+            if _summary_cache["services"] is not None:
+                return _summary_cache["services"].copy(), _summary_cache["categories"]
+            _summary_cache["loading"] = True
+            _summary_cache["pending"] = {}
+            generation = _summary_cache["generation"]
+
+        try:
+            services, categories = _load_summary()
+        except Exception:
+            with _summary_lock:
+                _summary_cache["loading"] = False
+                _summary_cache["pending"] = {}
+            raise
+
+        # Gộp kết quả đến trong lúc nạp và publish trong cùng một lần giữ lock,
+        # để không có kết quả nào rơi vào khoảng giữa hai bước
+        with _summary_lock:
+            _summary_cache["loading"] = False
+            pending = _summary_cache["pending"]
+            _summary_cache["pending"] = {}
+            for service_id, candidate in pending.items():
+                if service_id in services:
+                    services[service_id] = _newer(
+                        services[service_id], candidate)
+            # Không ghi đè nếu cache đã bị invalidate trong lúc nạp
+            if generation == _summary_cache["generation"]:
+                _summary_cache["services"] = services
+                _summary_cache["categories"] = categories
+            return services.copy(), categories
+
+
+def get_category_summary():
+    services, categories = _cached_summary()
+
+    summary = {
+        category_id: _empty_summary(category_id, name)
+        for category_id, name in categories.items()
+    }
+    for category_id, status, _ in services.values():
+        if category_id not in summary:
+            # Dịch vụ chưa có category
+            summary[category_id] = _empty_summary(category_id, None)
+        entry = summary[category_id]
+        status_name = status.value if status else "UNKNOWN"
+        entry["total"] += 1
+        entry[status_name.lower()] += 1
+        if entry["worst_status"] is None or \
+                _SEVERITY.index(status_name) > _SEVERITY.index(entry["worst_status"]):
+            entry["worst_status"] = status_name
+
+    return list(summary.values())